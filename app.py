@@ -1,18 +1,82 @@
 # app.py
+import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from fastapi import FastAPI
 from pydantic import BaseModel
 import ollama
 import chromadb
-import hashlib
-from sentence_transformers import SentenceTransformer
+from chromadb.errors import NotFoundError
+import xxhash
+from embedding import load_embedding_model
+from index_code import is_index_complete
+
+KEEP_ALIVE = "30m"  # Keep the model, and its cached prompt prefix, loaded between requests
+SYSTEM_PROMPT = "You are an assistant that answers questions about code."
+SEMANTIC_CACHE_SIZE = 256
+SEMANTIC_CACHE_THRESHOLD = 0.95  # Cosine similarity to reuse an earlier answer
 
-app = FastAPI()
 chroma_client = chromadb.PersistentClient(path="chroma_db")
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
+embedding_model = load_embedding_model(
+    num_threads=min(8, os.cpu_count() or 1), compile_model=True)
+# (path_hash, collection id, query) -> (query embedding, response), least recently used first
+answer_cache = OrderedDict()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Run one encode up front so the first request doesn't pay for model warm-up
+    # or compilation
+    embedding_model.encode(["warmup"], batch_size=1, convert_to_numpy=True)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 def get_path_hash(path: str) -> str:
-    return hashlib.sha256(path.encode()).hexdigest()
+    return xxhash.xxh3_128_hexdigest(path.encode())
+
+
+@lru_cache(maxsize=64)
+def get_collection(collection_name: str):
+    collection = chroma_client.get_collection(collection_name)
+    if not is_index_complete(collection):
+        # Still being built, or its build died: raising keeps it out of the cache
+        raise NotFoundError(f"Collection {collection_name} is not fully indexed")
+    return collection
+
+
+def get_cached_answer(path_hash: str, collection_id, query_embedding):
+    """Return the answer to a near-identical earlier query against the same index"""
+    for key, (embedding, response) in answer_cache.items():
+        # Embeddings are normalized, so the dot product is the cosine similarity
+        if key[:2] == (path_hash, collection_id) and \
+                float(embedding @ query_embedding) > SEMANTIC_CACHE_THRESHOLD:
+            break
+    else:
+        return None
+    answer_cache.move_to_end(key)
+    return response
+
+
+def cache_answer(path_hash: str, collection_id, query: str, query_embedding, response: str):
+    key = (path_hash, collection_id, query)
+    answer_cache[key] = (query_embedding, response)
+    answer_cache.move_to_end(key)
+    if len(answer_cache) > SEMANTIC_CACHE_SIZE:
+        answer_cache.popitem(last=False)
+
+
+def drop_cached_answers(path_hash: str):
+    for key in [key for key in answer_cache if key[0] == path_hash]:
+        del answer_cache[key]
+
+
+def no_index_error(path: str) -> dict:
+    return {"error": f"No index found for path: {path}" +
+            f"Existing collections: {chroma_client.list_collections()}"}
 
 
 class QueryRequest(BaseModel):
@@ -26,26 +90,51 @@ async def ask_code(request: QueryRequest):
     collection_name = "project_index_" + path_hash[:10]
 
     try:
-        collection = chroma_client.get_collection(collection_name)
-    except:
-        return {"error": f"No index found for path: {request.path}" +
-                f"Existing collections: {chroma_client.list_collections()}"}
+        collection = get_collection(collection_name)
+    except NotFoundError:
+        return no_index_error(request.path)
 
     # Embed query and search
-    query_embedding = embedding_model.encode([request.query]).tolist()[0]
-    results = collection.query(query_embeddings=[query_embedding], n_results=5)
+    query_embedding = embedding_model.encode(
+        [request.query], batch_size=1, convert_to_numpy=True, normalize_embeddings=True)
+    try:
+        results = collection.query(query_embeddings=query_embedding, n_results=5)
+    except NotFoundError:
+        # The path was reindexed since the collection was cached
+        get_collection.cache_clear()
+        drop_cached_answers(path_hash)
+        try:
+            collection = get_collection(collection_name)
+        except NotFoundError:
+            # Not recreated and filled yet: a reindex is running or failed
+            return no_index_error(request.path)
+        results = collection.query(query_embeddings=query_embedding, n_results=5)
+
+    # Checked after the query so a stale collection handle is detected first;
+    # a reindex creates a new collection id, which retires older answers
+    cached_answer = get_cached_answer(path_hash, collection.id, query_embedding[0])
+    if cached_answer is not None:
+        return {"response": cached_answer}
+
     context_chunks = results["documents"][0]
     context = "\n---\n".join(context_chunks)
 
-    prompt = f"""You are an assistant that answers questions about code.
-Context:
+    prompt = f"""Context:
 {context}
 
 Question: {request.query}
 Answer:"""
 
+    # A fixed system message keeps the prompt prefix identical across requests
+    # so Ollama can reuse its KV cache for it
     response = ollama.chat(model="deepseek-coder:6.7b", messages=[
+        {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": prompt}
-    ])
+    ], keep_alive=KEEP_ALIVE)
 
-    return {"response": response["message"]["content"]}
+    answer = response["message"]["content"]
+    # A partly filled collection keeps its id once complete, so its answers
+    # would outlive the reindex
+    if is_index_complete(collection):
+        cache_answer(path_hash, collection.id, request.query, query_embedding[0], answer)
+    return {"response": answer}
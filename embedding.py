@@ -0,0 +1,59 @@
+# embedding.py
+import platform
+import torch
+from sentence_transformers import SentenceTransformer
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+def select_onnx_file() -> str:
+    """Pick the dynamically quantized INT8 export in the model repo that suits this CPU"""
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "onnx/model_qint8_arm64.onnx"
+    try:
+        with open("/proc/cpuinfo") as f:
+            has_vnni = "avx512_vnni" in f.read()
+    except OSError:
+        has_vnni = False
+    if has_vnni:
+        return "onnx/model_qint8_avx512_vnni.onnx"
+    # u8u8 weights avoid the u8s8 saturation that hurts recall on CPUs without VNNI
+    return "onnx/model_quint8_avx2.onnx"
+
+
+ONNX_FILE_NAME = select_onnx_file()
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+ENCODE_BATCH_SIZE = 256 if DEVICE == "cuda" else 32
+# Identifies which weights produced a vector, so cached embeddings never mix
+MODEL_ID = f"{MODEL_NAME}:{'cuda-fp16' if DEVICE == 'cuda' else ONNX_FILE_NAME}"
+
+
+def load_embedding_model(num_threads: int | None = None,
+                         compile_model: bool = False) -> SentenceTransformer:
+    """Load MiniLM in FP16 on the GPU, or on ONNX Runtime with INT8 weights on CPU
+
+    num_threads caps the CPU threads used by this model, e.g. inside pool workers.
+    compile_model runs the GPU model through torch.compile, which only pays off
+    in long-lived processes; the ONNX graph is already compiled ahead of time.
+    """
+    if DEVICE == "cuda":
+        model = SentenceTransformer(MODEL_NAME, device=DEVICE).half()
+        if compile_model:
+            # Dynamic shapes avoid recompiling for every new sequence length
+            model[0].auto_model.compile(dynamic=True)
+        return model
+
+    model_kwargs = {"file_name": ONNX_FILE_NAME}
+    if num_threads:
+        import onnxruntime
+
+        torch.set_num_threads(num_threads)
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = num_threads
+        model_kwargs["session_options"] = session_options
+
+    return SentenceTransformer(
+        MODEL_NAME,
+        backend="onnx",
+        model_kwargs=model_kwargs,
+    )
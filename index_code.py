@@ -2,17 +2,44 @@
 import argparse
 import os
 import hashlib
-from sentence_transformers import SentenceTransformer
+import xxhash
+import itertools
+import multiprocessing
+import sqlite3
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from embedding import DEVICE, ENCODE_BATCH_SIZE, MODEL_ID, load_embedding_model
 import chromadb
+from chromadb.errors import NotFoundError
 import pathspec
 
-EXTENSIONS = [".js", ".json", ".md"]
-MAX_BATCH_SIZE = 500  # Safe batch size for ChromaDB
+EXTENSIONS = (".js", ".json", ".md")  # tuple so str.endswith checks them in C
+SKIP_DIRS = {".git", "node_modules"}
+DEFAULT_MAX_BATCH_SIZE = 5461  # Chroma's per-request limit on its SQLite backend
+CHUNK_TOKENS = 200  # Fits MiniLM's 256-token window with room for special tokens
+CHUNK_OVERLAP_TOKENS = 20
+READ_WORKERS = 16
+READ_AHEAD = READ_WORKERS * 2  # Most files read but not yet chunked at any time
+STREAM_BLOCK_SIZE = 2 ** 16
+STREAM_MIN_FILE_SIZE = 2 ** 20  # Larger files are streamed instead of read whole
+POOL_MIN_CHUNKS = 1000  # Smaller windows are encoded in-process
+POOL_WORKER_THREADS = 4
+EMBEDDING_CACHE_PATH = "embedding_cache.db"
+SQLITE_MAX_PARAMS = 900  # Stay under SQLite's default host parameter limit
+
+_worker_model = None
 
 
 def get_hash(path: str) -> str:
     """Hash path string to detect changes"""
-    return hashlib.sha256(path.encode()).hexdigest()
+    return xxhash.xxh3_128_hexdigest(path.encode())
+
+
+def get_chunk_hash(chunk: str) -> str:
+    """Hash chunk content and the embedding model to key the embedding cache"""
+    return hashlib.sha256(f"{MODEL_ID}\0{chunk}".encode()).hexdigest()
 
 
 def load_gitignore(path: str):
@@ -24,55 +51,243 @@ def load_gitignore(path: str):
     return None
 
 
-def is_ignored(filepath: str, spec: pathspec.PathSpec, root_path: str) -> bool:
+def is_ignored(filepath: str, spec: pathspec.PathSpec, root_path: str,
+               is_dir: bool = False) -> bool:
     rel_path = os.path.relpath(filepath, root_path)
+    if is_dir:
+        # Trailing slash lets directory-only patterns such as "build/" match
+        rel_path += "/"
     return spec.match_file(rel_path)
 
 
-def load_chunks(source_dir: str, chunk_size=800):
-    chunks = []
+def iter_source_files(source_dir: str, spec):
+    """Yield paths of files to index, pruning skipped and ignored directories"""
+    # A negated pattern such as "!foo/keep.md" can re-include files under an
+    # ignored directory, so directories are only pruned without negations
+    prune_ignored = spec is not None and not any(
+        pattern.include is False for pattern in spec.patterns)
+    pending = [source_dir]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except OSError:
+            # Unreadable directories are skipped, as os.walk does
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name in SKIP_DIRS:
+                        continue
+                    if prune_ignored and is_ignored(entry.path, spec, source_dir, is_dir=True):
+                        continue
+                    pending.append(entry.path)
+                elif entry.name.endswith(EXTENSIONS) and entry.is_file():
+                    if spec and is_ignored(entry.path, spec, source_dir):
+                        continue
+                    yield entry.path
+
+
+def split_by_tokens(blocks, tokenizer, chunk_tokens=CHUNK_TOKENS,
+                    overlap=CHUNK_OVERLAP_TOKENS):
+    """Split streamed text into overlapping token windows, sliced from the original text"""
+    buffer = ""
+    start = 0
+    for block in itertools.chain(blocks, [None]):
+        at_end = block is None
+        buffer += block or ""
+        # Offsets keep the original casing and whitespace, which decoding would lose
+        encoding = tokenizer(buffer, add_special_tokens=False,
+                             return_offsets_mapping=True, verbose=False)
+        offsets = encoding["offset_mapping"]
+        word_ids = encoding.word_ids()
+        # Until the input ends, hold back the last word since it may continue
+        # in the next block and split into different pieces
+        stable = len(offsets)
+        if not at_end:
+            while stable > 0 and word_ids[stable - 1] == word_ids[-1]:
+                stable -= 1
+        while start < len(offsets) and (at_end or start + chunk_tokens <= stable):
+            window = offsets[start:start + chunk_tokens]
+            yield buffer[window[0][0]:window[-1][1]]
+            if start + chunk_tokens >= len(offsets):
+                break
+            start += chunk_tokens - overlap
+        if not at_end and start < len(offsets):
+            # Carry from the start of the word holding the next window's first
+            # token: re-tokenizing from a "##" piece would split it differently
+            word_start = start
+            while word_start > 0 and word_ids[word_start - 1] == word_ids[start]:
+                word_start -= 1
+            buffer = buffer[offsets[word_start][0]:]
+            start -= word_start
+
+
+def iter_blocks(path: str):
+    with open(path, encoding="utf-8", errors="ignore", buffering=STREAM_BLOCK_SIZE) as file:
+        while block := file.read(STREAM_BLOCK_SIZE):
+            yield block
+
+
+def read_file(path: str):
+    """Read small files whole on the calling thread, stream large ones lazily"""
+    if os.path.getsize(path) >= STREAM_MIN_FILE_SIZE:
+        return iter_blocks(path)
+    with open(path, encoding="utf-8", errors="ignore") as file:
+        return [file.read()]
+
+
+def read_files(paths):
+    """Read files on worker threads in order, with a bounded number of reads in flight"""
+    # Unlike executor.map, this doesn't walk every path and submit every read up front
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        in_flight = deque(executor.submit(read_file, path)
+                          for path in itertools.islice(paths, READ_AHEAD))
+        while in_flight:
+            blocks = in_flight.popleft().result()
+            for path in itertools.islice(paths, 1):
+                in_flight.append(executor.submit(read_file, path))
+            yield blocks
+
+
+def load_chunks(source_dir: str, tokenizer):
+    """Yield chunks of all files to index, in traversal order
+
+    Memory stays bounded by READ_AHEAD small files plus one streamed block,
+    whatever the size of the tree.
+    """
     spec = load_gitignore(source_dir)
 
     print(f"Extensions to be processed {EXTENSIONS}")
-    # files_count = len(os.listdir(source_dir))
-    # print(f"Total files count - {files_count}")
-    for root, _, files in os.walk(source_dir):
-        for f in files:
-            full_path = os.path.join(root, f)
-
-            if spec and is_ignored(full_path, spec, source_dir):
-                continue
-
-            if any(f.endswith(ext) for ext in EXTENSIONS):
-                # print(f"Reading file - {full_path}")
-                with open(full_path, encoding="utf-8", errors="ignore") as file:
-                    content = file.read()
-                    for i in range(0, len(content), chunk_size):
-                        chunk = content[i:i + chunk_size]
-                        chunks.append(chunk)
-
-    return chunks
-
-
-def add_to_collection_in_batches(collection, documents, embeddings):
-    total = len(documents)
-    for i in range(0, total, MAX_BATCH_SIZE):
-        batch_docs = documents[i:i + MAX_BATCH_SIZE]
-        batch_embs = embeddings[i:i + MAX_BATCH_SIZE]
-        batch_ids = [f"id_{i+j}" for j in range(len(batch_docs))]
-
-        collection.add(
-            documents=batch_docs,
-            embeddings=batch_embs,
-            ids=batch_ids
+    # Reads and the directory walk overlap with chunking here
+    for blocks in read_files(iter_source_files(source_dir, spec)):
+        yield from split_by_tokens(blocks, tokenizer)
+
+
+def _init_pool_worker():
+    global _worker_model
+    _worker_model = load_embedding_model(num_threads=POOL_WORKER_THREADS)
+
+
+def _encode_in_worker(chunks):
+    return _worker_model.encode(
+        chunks,
+        batch_size=ENCODE_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+    )
+
+
+def count_pool_workers() -> int:
+    return (os.cpu_count() or 1) // POOL_WORKER_THREADS
+
+
+def start_encode_pool():
+    """Start CPU worker processes that each hold their own copy of the model
+
+    Workers are only spawned once the pool is first used. Returns None when the
+    machine is too small for two workers, so chunks are encoded in-process.
+    """
+    workers = count_pool_workers()
+    if workers < 2:
+        return None
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_pool_worker,
+    )
+
+
+def encode_chunks(model, chunks, pool=None):
+    """Encode chunks shortest-first so each batch pads to similar lengths"""
+    order = np.argsort([len(c) for c in chunks], kind="stable")
+    sorted_chunks = [chunks[i] for i in order]
+    if pool:
+        # One task per worker so none sit idle; striding gives each task an even
+        # share of short and long chunks while keeping it sorted
+        workers = count_pool_workers()
+        tasks = [sorted_chunks[i::workers] for i in range(workers)]
+        sorted_embeddings = np.empty(
+            (len(chunks), model.get_sentence_embedding_dimension()), dtype=np.float32)
+        for i, task_embeddings in enumerate(pool.map(_encode_in_worker, tasks)):
+            sorted_embeddings[i::workers] = task_embeddings
+    else:
+        sorted_embeddings = model.encode(
+            sorted_chunks,
+            batch_size=ENCODE_BATCH_SIZE,
+            show_progress_bar=True,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
         )
+    embeddings = np.empty_like(sorted_embeddings)
+    embeddings[order] = sorted_embeddings
+    return embeddings
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("path", help="Path to the source directory")
-    args = parser.parse_args()
-    path = os.path.abspath(args.path)
+def open_embedding_cache(path: str = EMBEDDING_CACHE_PATH):
+    cache = sqlite3.connect(path)
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, embedding BLOB NOT NULL)")
+    return cache
+
+
+def embed_with_cache(model, chunks, cache, pool=None):
+    """Reuse cached embeddings and only encode chunks that were not seen before"""
+    hashes = [get_chunk_hash(c) for c in chunks]
+    cached = {}
+    for i in range(0, len(hashes), SQLITE_MAX_PARAMS):
+        part = hashes[i:i + SQLITE_MAX_PARAMS]
+        placeholders = ",".join("?" * len(part))
+        rows = cache.execute(
+            f"SELECT hash, embedding FROM embeddings WHERE hash IN ({placeholders})", part)
+        cached.update(rows)
+
+    embeddings = np.empty(
+        (len(chunks), model.get_sentence_embedding_dimension()), dtype=np.float32)
+    # Chunk hash -> every position holding that chunk, so duplicates are encoded once
+    missing = {}
+    for i, h in enumerate(hashes):
+        if h in cached:
+            embeddings[i] = np.frombuffer(cached[h], dtype=np.float16)
+        else:
+            missing.setdefault(h, []).append(i)
+    missing_count = sum(len(positions) for positions in missing.values())
+    print(f"♻️ Reused {len(chunks) - missing_count} cached embeddings, "
+          f"skipped {missing_count - len(missing)} duplicate chunks.")
+
+    if missing:
+        missing_chunks = [chunks[positions[0]] for positions in missing.values()]
+        if pool and len(missing_chunks) > POOL_MIN_CHUNKS:
+            new_embeddings = encode_chunks(model, missing_chunks, pool)
+        else:
+            new_embeddings = encode_chunks(model, missing_chunks)
+        for positions, embedding in zip(missing.values(), new_embeddings):
+            embeddings[positions] = embedding
+
+        # Stored as float16 to halve the cache size on disk
+        cache.executemany(
+            "INSERT OR REPLACE INTO embeddings (hash, embedding) VALUES (?, ?)",
+            ((h, e.astype(np.float16).tobytes())
+             for h, e in zip(missing, new_embeddings)))
+        cache.commit()
+
+    return embeddings
+
+
+def get_max_batch_size(chroma_client) -> int:
+    """Largest batch Chroma accepts in a single add call"""
+    if hasattr(chroma_client, "get_max_batch_size"):
+        return chroma_client.get_max_batch_size()
+    return DEFAULT_MAX_BATCH_SIZE
+
+
+def is_index_complete(collection) -> bool:
+    """Whether run_index finished adding every chunk to collection"""
+    return bool((collection.metadata or {}).get("indexed"))
+
+
+def run_index(path: str, model=None):
+    """Rebuild the index for path, reusing an already loaded embedding model if given"""
     path_hash = get_hash(path)
 
     chroma_client = chromadb.PersistentClient(path="chroma_db")
@@ -82,21 +297,46 @@ def main():
     try:
         chroma_client.delete_collection(name=collection_name)
         print(f"🗑️ Deleted existing collection for: {path}")
-    except Exception:
+    except (NotFoundError, ValueError):
+        # Raised when there is nothing to delete, depending on the Chroma backend
         pass
 
     collection = chroma_client.get_or_create_collection(name=collection_name)
 
     print(f"Indexing source code at {path}...")
-    model = SentenceTransformer("all-MiniLM-L6-v2")
-    chunks = load_chunks(path)
-    embeddings = model.encode(chunks, show_progress_bar=True).tolist()
-
-    add_to_collection_in_batches(collection, chunks, embeddings)
+    if model is None:
+        model = load_embedding_model()
+    chunks = load_chunks(path, model.tokenizer)
+    total = 0
+    cache = open_embedding_cache()
+    pool = start_encode_pool() if DEVICE == "cpu" else None
+    try:
+        with pool or nullcontext():
+            # Only one Chroma batch of chunks and embeddings is held in memory at a time
+            for batch in itertools.batched(chunks, get_max_batch_size(chroma_client)):
+                batch = list(batch)
+                embeddings = embed_with_cache(model, batch, cache, pool)
+                collection.add(
+                    documents=batch,
+                    embeddings=embeddings,
+                    ids=[f"id_{total + i}" for i in range(len(batch))]
+                )
+                total += len(batch)
+    finally:
+        cache.close()
+    # Set last, so a run that dies midway leaves a collection readers skip
+    collection.modify(metadata={"indexed": True})
 
-    print(f"✅ Indexed {len(chunks)} chunks.")
+    print(f"✅ Indexed {total} chunks.")
     print(f"All existing collections: {chroma_client.list_collections()}")
 
 
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="Path to the source directory")
+    args = parser.parse_args()
+    run_index(os.path.abspath(args.path))
+
+
 if __name__ == "__main__":
     main()
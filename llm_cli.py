@@ -1,5 +1,6 @@
 # llm_cli.py
 import argparse
+import atexit
 import httpx
 from rich.console import Console
 import subprocess
@@ -7,20 +8,25 @@ import shutil
 import json
 import time
 import os
-import hashlib
+from functools import cache
+import xxhash
 import chromadb
-from sentence_transformers import SentenceTransformer
+from chromadb.errors import NotFoundError
+from embedding import load_embedding_model
+from index_code import is_index_complete, run_index
 
 console = Console()
-chroma_client = chromadb.PersistentClient(path="chroma_db")
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
 EMBEDDING_RESULTS = 20
 TEMPERATURE = 0.3
+KEEP_ALIVE = "30m"  # Keep the model, and its cached prompt prefix, loaded between runs
+SYSTEM_PROMPT = """You are an assistant that answers questions about code based ONLY on the provided context.
+You are permitted to make suggestions if you can't bet your life on it that it's from the context
+If the answer is not contained within the context, say "I don't know.\""""
 
 
 def is_ollama_running():
     try:
-        httpx.get("http://localhost:11434", timeout=2)
+        get_ollama_client().get("/", timeout=2)
         return True
     except httpx.RequestError:
         return False
@@ -49,7 +55,7 @@ def try_start_ollama():
 
 def ensure_model_available(model: str):
     try:
-        response = httpx.get("http://localhost:11434/api/tags", timeout=5)
+        response = get_ollama_client().get("/api/tags", timeout=5)
         tags = response.json().get("models", [])
         local_models = [m["name"] for m in tags]
         if model in local_models:
@@ -63,8 +69,35 @@ def ensure_model_available(model: str):
         exit(1)
 
 
+# Clients and the model are created on first use rather than at import, since
+# the indexer's spawned pool workers re-import this module
+@cache
+def get_ollama_client():
+    # Shared clients keep connections alive across calls instead of reconnecting each time
+    client = httpx.Client(base_url="http://localhost:11434", timeout=None)
+    atexit.register(client.close)
+    return client
+
+
+@cache
+def get_api_client():
+    client = httpx.Client(base_url="http://localhost:8000")
+    atexit.register(client.close)
+    return client
+
+
+@cache
+def get_chroma_client():
+    return chromadb.PersistentClient(path="chroma_db")
+
+
+@cache
+def get_embedding_model():
+    return load_embedding_model()
+
+
 def get_path_hash(path: str) -> str:
-    return hashlib.sha256(path.encode()).hexdigest()
+    return xxhash.xxh3_128_hexdigest(path.encode())
 
 
 def get_context_from_embeddings(path: str, query: str) -> str:
@@ -72,41 +105,46 @@ def get_context_from_embeddings(path: str, query: str) -> str:
     collection_name = "project_index_" + path_hash[:10]
 
     try:
-        collection = chroma_client.get_collection(collection_name)
-    except:
+        collection = get_chroma_client().get_collection(collection_name)
+    except NotFoundError:
         raise RuntimeError(f"No index found for path: {path}")
+    if not is_index_complete(collection):
+        raise RuntimeError(f"Index for path is incomplete, rerun with --reindex: {path}")
 
-    query_embedding = embedding_model.encode([query]).tolist()[0]
+    query_embedding = get_embedding_model().encode(
+        [query], batch_size=1, convert_to_numpy=True, normalize_embeddings=True)
     results = collection.query(
-        query_embeddings=[query_embedding], n_results=EMBEDDING_RESULTS)
+        query_embeddings=query_embedding, n_results=EMBEDDING_RESULTS)
     context_chunks = results["documents"][0]
     return "\n---\n".join(context_chunks)
 
 
-def build_prompt(context: str, query: str) -> str:
-    return f"""You are an assistant that answers questions about code based ONLY on the provided context.
-You are permitted to make suggestions if you can't bet your life on it that it's from the context
-If the answer is not contained within the context, say "I don't know."
-Context:
+def build_messages(context: str, query: str) -> list[dict]:
+    # The fixed system message is an identical prompt prefix on every call,
+    # so Ollama can reuse its KV cache and only process the context and question
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"""Context:
 {context}
 
 Question: {query} in the context
-Answer:"""
+Answer:"""},
+    ]
 
 
-def stream_local_chat(model: str, prompt: str):
-    url = "http://localhost:11434/api/chat"
+def stream_local_chat(model: str, messages: list[dict]):
     headers = {"Content-Type": "application/json"}
     payload = {
         "model": model,
-        "messages": [{"role": "user", "content": prompt}],
+        "messages": messages,
         "stream": True,
+        "keep_alive": KEEP_ALIVE,
         "options": {
             "temperature": TEMPERATURE
         }
     }
 
-    with httpx.stream("POST", url, headers=headers, json=payload, timeout=None) as response:
+    with get_ollama_client().stream("POST", "/api/chat", headers=headers, json=payload) as response:
         if response.status_code != 200:
             console.print(
                 f"[red]Error: {response.status_code} - {response.text}[/red]")
@@ -123,11 +161,10 @@ def stream_local_chat(model: str, prompt: str):
 
 
 def stream_remote_chat(path: str, query: str):
-    url = "http://localhost:8000/ask"
     payload = {"path": path, "query": query}
 
     try:
-        response = httpx.post(url, json=payload, timeout=60)
+        response = get_api_client().post("/ask", json=payload, timeout=60)
         response.raise_for_status()
         content = response.json().get("response")
         console.print(content, style="cyan")
@@ -139,11 +176,14 @@ def is_path_indexed(path: str) -> bool:
     path_hash = get_path_hash(path)
     collection_name = "project_index_" + path_hash[:10]
     try:
-        collection = chroma_client.get_collection(name=collection_name)
-        ids = collection.get(limit=1).get("ids", [])
-        return len(ids) > 0
-    except Exception:
+        collection = get_chroma_client().get_collection(name=collection_name)
+        return is_index_complete(collection)
+    except NotFoundError:
         return False
+    except Exception as e:
+        # Anything else is a real failure, not a missing index worth rebuilding
+        console.print(f"[red]Failed to check index for {path}: {e}[/red]")
+        exit(1)
 
 
 def run_indexer(path: str, force: bool):
@@ -153,7 +193,7 @@ def run_indexer(path: str, force: bool):
 
     console.print(f"[blue]Indexing code at {path}...[/blue]")
     try:
-        subprocess.run(["python", "index_code.py", path], check=True)
+        run_index(path, model=get_embedding_model())
     except Exception as e:
         console.print(f"[red]Error during indexing: {e}[/red]")
         exit(1)
@@ -195,8 +235,8 @@ def main():
             console.print(f"[red]{e}[/red]")
             return
 
-        prompt = build_prompt(context, args.query)
-        stream_local_chat(args.model, prompt)
+        messages = build_messages(context, args.query)
+        stream_local_chat(args.model, messages)
     else:
         stream_remote_chat(abs_path, args.query)
 
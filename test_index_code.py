@@ -0,0 +1,67 @@
+# test_index_code.py
+import random
+import re
+
+import pytest
+
+from index_code import split_by_tokens
+
+
+class StubEncoding(dict):
+    def __init__(self, offsets, word_ids):
+        super().__init__(offset_mapping=offsets)
+        self._word_ids = word_ids
+
+    def word_ids(self):
+        return self._word_ids
+
+
+def stub_tokenizer(text, **kwargs):
+    """Split words into 3-char pieces aligned to the word end, like WordPiece "##" pieces
+
+    Every piece depends on the whole word, so a word cut at a block boundary or
+    tokenized from one of its pieces splits differently, which is what the
+    streaming chunker has to cope with.
+    """
+    offsets = []
+    word_ids = []
+    for word_id, match in enumerate(re.finditer(r"\w+|[^\w\s]", text)):
+        start = match.start()
+        for end in range(match.start() + (len(match[0]) % 3 or 3), match.end() + 1, 3):
+            offsets.append((start, end))
+            word_ids.append(word_id)
+            start = end
+    return StubEncoding(offsets, word_ids)
+
+
+def random_text(rng):
+    parts = ["ab", "abcdefgh", "x", " ", "\n", ".", "(", "longerwordpiece", "  "]
+    return "".join(rng.choice(parts) for _ in range(rng.randint(0, 400)))
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 5, 17, 64, 1000])
+def test_streamed_chunks_match_whole_file(block_size):
+    rng = random.Random(block_size)
+    for _ in range(100):
+        text = random_text(rng)
+        blocks = [text[i:i + block_size] for i in range(0, len(text), block_size)]
+
+        whole = list(split_by_tokens([text], stub_tokenizer, chunk_tokens=10, overlap=3))
+        streamed = list(split_by_tokens(blocks, stub_tokenizer, chunk_tokens=10, overlap=3))
+
+        assert streamed == whole
+
+
+def test_windows_overlap_and_cover_text():
+    text = " ".join(f"w{i}" for i in range(25))
+
+    chunks = list(split_by_tokens([text], stub_tokenizer, chunk_tokens=10, overlap=2))
+
+    assert chunks[0].split()[0] == "w0"
+    assert chunks[1].split()[0] == "w8"
+    assert chunks[-1].split()[-1] == "w24"
+
+
+def test_empty_and_whitespace_files_have_no_chunks():
+    assert list(split_by_tokens([], stub_tokenizer)) == []
+    assert list(split_by_tokens(["  \n", " "], stub_tokenizer)) == []